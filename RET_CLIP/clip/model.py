@@ -1,9 +1,10 @@
 from collections import OrderedDict
 from typing import Tuple, Union
-from itertools import repeat
 import collections.abc
+import functools
 
 import math
+import re
 import logging
 import numpy as np
 import torch
@@ -11,16 +12,33 @@ import torch.nn.functional as F
 import timm
 from torch import nn
 from torch.utils.checkpoint import checkpoint
-
-import importlib.util
-
-if importlib.util.find_spec('flash_attn'):
-    FlashMHA = importlib.import_module('flash_attn.flash_attention').FlashMHA
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 from RET_CLIP.clip import _tokenizer
 from RET_CLIP.clip.configuration_bert import BertConfig
 from RET_CLIP.clip.modeling_bert import BertModel
 
+def _scaled_dot_product_attention_math(query, key, value, attn_mask=None):
+    attn = (query * query.shape[-1] ** -0.5) @ key.transpose(-2, -1)
+    if attn_mask is not None:
+        attn = attn + attn_mask
+    return attn.softmax(dim=-1) @ value
+
+
+def scaled_dot_product_attention(query, key, value, attn_mask=None):
+    # torch < 2.0 ships without the fused attention kernel, and the ONNX exporter has no symbolic for it below
+    # opset 14, so both fall back to the explicit matmul-softmax, which traces into plain ops.
+    if not hasattr(F, 'scaled_dot_product_attention') or torch.onnx.is_in_onnx_export():
+        return _scaled_dot_product_attention_math(query, key, value, attn_mask)
+    return F.scaled_dot_product_attention(query, key, value, attn_mask)
+
+
+def _fuse_conv_bn(module, pairs):
+    """Fold each BatchNorm into its preceding convolution for the (conv, bn) attribute name pairs of module."""
+    for conv, bn in pairs:
+        setattr(module, conv, fuse_conv_bn_eval(getattr(module, conv), getattr(module, bn)))
+        setattr(module, bn, nn.Identity())
+
 
 class RestNetBasicBlock(nn.Module):
     def __init__(self, in_channels, out_channels, stride):
@@ -105,6 +123,17 @@ class Bottleneck(nn.Module):
         out = self.relu(out)
         return out
 
+    def fuse_for_inference(self):
+        """Fold each BatchNorm into its preceding convolution, including the downsampling branch.
+
+        The fused block can no longer be trained, so only call this on an eval-mode block used for inference.
+        """
+        assert not self.training, "Conv-BN fusion is only valid in eval mode."
+        _fuse_conv_bn(self, [("conv1", "bn1"), ("conv2", "bn2"), ("conv3", "bn3")])
+        if self.downsample is not None:
+            _fuse_conv_bn(self.downsample, [("0", "1")])
+        return self
+
 
 class AttentionPool2d(nn.Module):
     def __init__(self, spacial_dim: int, embed_dim: int, num_heads: int, output_dim: int = None):
@@ -117,30 +146,19 @@ class AttentionPool2d(nn.Module):
         self.num_heads = num_heads
 
     def forward(self, x):
-        x = x.reshape(x.shape[0], x.shape[1], x.shape[2] * x.shape[3]).permute(2, 0, 1)  # NCHW -> (HW)NC
-        x = torch.cat([x.mean(dim=0, keepdim=True), x], dim=0)  # (HW+1)NC
-        x = x + self.positional_embedding[:, None, :].to(x.dtype)  # (HW+1)NC
-        x, _ = F.multi_head_attention_forward(
-            query=x, key=x, value=x,
-            embed_dim_to_check=x.shape[-1],
-            num_heads=self.num_heads,
-            q_proj_weight=self.q_proj.weight,
-            k_proj_weight=self.k_proj.weight,
-            v_proj_weight=self.v_proj.weight,
-            in_proj_weight=None,
-            in_proj_bias=torch.cat([self.q_proj.bias, self.k_proj.bias, self.v_proj.bias]),
-            bias_k=None,
-            bias_v=None,
-            add_zero_attn=False,
-            dropout_p=0,
-            out_proj_weight=self.c_proj.weight,
-            out_proj_bias=self.c_proj.bias,
-            use_separate_proj_weight=True,
-            training=self.training,
-            need_weights=False
-        )
+        x = x.reshape(x.shape[0], x.shape[1], x.shape[2] * x.shape[3]).permute(0, 2, 1)  # NCHW -> N(HW)C
+        x = torch.cat([x.mean(dim=1, keepdim=True), x], dim=1)  # N(HW+1)C
+        x = x + self.positional_embedding.to(x.dtype)  # N(HW+1)C
+        N, L, C = x.shape
+        head_dim = C // self.num_heads
+
+        # only the pooled (first) token is returned, so it is the only query that needs to be computed
+        q = self.q_proj(x[:, :1]).reshape(N, 1, self.num_heads, head_dim).transpose(1, 2)  # [N, heads, 1, head_dim]
+        k = self.k_proj(x).reshape(N, L, self.num_heads, head_dim).transpose(1, 2)  # [N, heads, L, head_dim]
+        v = self.v_proj(x).reshape(N, L, self.num_heads, head_dim).transpose(1, 2)  # [N, heads, L, head_dim]
+        x = scaled_dot_product_attention(q, k, v)
 
-        return x[0]
+        return self.c_proj(x.reshape(N, C))
 
 
 class ModifiedResNet(nn.Module):
@@ -176,6 +194,9 @@ class ModifiedResNet(nn.Module):
         embed_dim = width * 32  # the ResNet feature dimension
         self.attnpool = AttentionPool2d(input_resolution // 32, embed_dim, heads, output_dim)
 
+        # NHWC lets cuDNN pick its faster channels-last convolution and BatchNorm kernels
+        self.to(memory_format=torch.channels_last)
+
     def _make_layer(self, planes, blocks, stride=1):
         layers = [Bottleneck(self._inplanes, planes, stride)]
 
@@ -190,6 +211,18 @@ class ModifiedResNet(nn.Module):
         # FIXME support for non-transformer
         pass
 
+    def fuse_for_inference(self):
+        """Fold the BatchNorm layers of the stem and all bottlenecks into their convolutions.
+
+        The fused model can no longer be trained, so only call this on an eval-mode model used for inference.
+        """
+        assert not self.training, "Conv-BN fusion is only valid in eval mode."
+        _fuse_conv_bn(self, [("conv1", "bn1"), ("conv2", "bn2"), ("conv3", "bn3")])
+        for layer in [self.layer1, self.layer2, self.layer3, self.layer4]:
+            for block in layer:
+                block.fuse_for_inference()
+        return self
+
     def forward(self, x):
         def stem(x):
             for conv, bn in [(self.conv1, self.bn1), (self.conv2, self.bn2), (self.conv3, self.bn3)]:
@@ -197,7 +230,7 @@ class ModifiedResNet(nn.Module):
             x = self.avgpool(x)
             return x
 
-        x = x.type(self.conv1.weight.dtype)
+        x = x.to(dtype=self.conv1.weight.dtype, memory_format=torch.channels_last)
         x = stem(x)
         x = self.layer1(x)
         x = self.layer2(x)
@@ -212,6 +245,11 @@ class LayerNorm(nn.LayerNorm):
     """Subclass torch's LayerNorm to handle fp16."""
 
     def forward(self, x: torch.Tensor):
+        if x.is_cuda and x.dtype == self.weight.dtype:
+            # the CUDA kernel already accumulates fp16/bf16 inputs in fp32, no need for an explicit round-trip.
+            # Only pure fp16 (--precision fp16) takes this path: under amp the weights stay fp32, and autocast runs
+            # layer_norm in fp32 anyway, so the round-trip below costs nothing extra there.
+            return F.layer_norm(x, self.normalized_shape, self.weight, self.bias, self.eps)
         orig_type = x.dtype
         ret = super().forward(x.type(torch.float32))
         return ret.type(orig_type)
@@ -222,11 +260,41 @@ class QuickGELU(nn.Module):
         return x * torch.sigmoid(1.702 * x)
 
 
+class MultiheadAttention(nn.Module):
+    """Batch-first ([N, L, D]) self-attention with a fused QKV projection on top of scaled_dot_product_attention.
+
+    Parameter names match nn.MultiheadAttention so that existing checkpoints load unchanged.
+    """
+
+    def __init__(self, embed_dim: int, num_heads: int):
+        super().__init__()
+        assert embed_dim % num_heads == 0, "embed_dim must be divisible by num_heads"
+        self.embed_dim = embed_dim
+        self.num_heads = num_heads
+        self.head_dim = embed_dim // num_heads
+
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * embed_dim, embed_dim))
+        self.in_proj_bias = nn.Parameter(torch.empty(3 * embed_dim))
+        self.out_proj = nn.Linear(embed_dim, embed_dim)
+
+        nn.init.xavier_uniform_(self.in_proj_weight)
+        nn.init.zeros_(self.in_proj_bias)
+        nn.init.zeros_(self.out_proj.bias)
+
+    def forward(self, x: torch.Tensor, attn_mask: torch.Tensor = None):
+        N, L, D = x.shape  # NLD
+        qkv = F.linear(x, self.in_proj_weight, self.in_proj_bias)
+        q, k, v = qkv.reshape(N, L, 3, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4)  # 3 x [N, heads, L, head_dim]
+        x = scaled_dot_product_attention(q, k, v, attn_mask)
+        x = x.transpose(1, 2).reshape(N, L, D)
+        return self.out_proj(x)
+
+
 class ResidualAttentionBlock(nn.Module):
-    def __init__(self, d_model: int, n_head: int, attn_mask: torch.Tensor = None, use_flash_attention: bool = False):
+    def __init__(self, d_model: int, n_head: int, attn_mask: torch.Tensor = None):
         super().__init__()
 
-        self.attn = nn.MultiheadAttention(d_model, n_head) if not use_flash_attention else FlashMHA(d_model, n_head)
+        self.attn = MultiheadAttention(d_model, n_head)
         self.ln_1 = LayerNorm(d_model)
         self.mlp = nn.Sequential(OrderedDict([
             ("c_fc", nn.Linear(d_model, d_model * 4)),
@@ -234,16 +302,12 @@ class ResidualAttentionBlock(nn.Module):
             ("c_proj", nn.Linear(d_model * 4, d_model))
         ]))
         self.ln_2 = LayerNorm(d_model)
-        self.attn_mask = attn_mask
-        self.use_flash_attention = use_flash_attention
+        # a buffer follows model.to()/.cuda(), so forward never has to move or rebind it
+        self.register_buffer("attn_mask", attn_mask, persistent=False)
 
     def attention(self, x: torch.Tensor):
-        self.attn_mask = self.attn_mask.to(dtype=x.dtype, device=x.device) if self.attn_mask is not None else None
-        if self.use_flash_attention:
-            # Batch first is needed for FlashAttention. See https://github.com/HazyResearch/flash-attention/issues/84 for more information.
-            return self.attn(x.transpose(1, 0))[0].transpose(1, 0)
-        else:
-            return self.attn(x, x, x, need_weights=False, attn_mask=self.attn_mask)[0]
+        attn_mask = self.attn_mask.to(dtype=x.dtype) if self.attn_mask is not None else None
+        return self.attn(x, attn_mask=attn_mask)
 
     def forward(self, x: torch.Tensor):
         x = x + self.attention(self.ln_1(x))
@@ -252,27 +316,35 @@ class ResidualAttentionBlock(nn.Module):
 
 
 class Transformer(nn.Module):
-    def __init__(self, width: int, layers: int, heads: int, attn_mask: torch.Tensor = None,
-                 use_flash_attention: bool = False):
+    def __init__(self, width: int, layers: int, heads: int, attn_mask: torch.Tensor = None):
         super().__init__()
         self.width = width
         self.layers = layers
         self.grad_checkpointing = False
         self.resblocks = nn.Sequential(
-            *[ResidualAttentionBlock(width, heads, attn_mask, use_flash_attention) for _ in range(layers)])
+            *[ResidualAttentionBlock(width, heads, attn_mask) for _ in range(layers)])
         print('transformer int finished')
 
+    def compile_resblocks(self, **compile_kwargs):
+        """Compile the residual blocks in place with torch.compile (torch >= 2.2).
+
+        Compiling in place keeps the parameter names, so checkpoints are unaffected. Each block is compiled on its own,
+        since the grad-checkpointing path calls the blocks one by one.
+        """
+        for r in self.resblocks:
+            r.compile(**compile_kwargs)
+
     def forward(self, x: torch.Tensor):
         if self.grad_checkpointing and not torch.jit.is_scripting():
             for r in self.resblocks:
-                x = checkpoint(r, x)
+                x = checkpoint(r, x, use_reentrant=False)
             return x
         return self.resblocks(x)
 
 
 class VisualTransformer(nn.Module):
     def __init__(self, input_resolution: int, patch_size: int, width: int, layers: int, heads: int, output_dim: int,
-                 use_flash_attention: bool = False, use_rn_for_embed: bool = False):
+                 use_rn_for_embed: bool = False):
         super().__init__()
         self.input_resolution = input_resolution
         self.grid_size = (self.input_resolution // patch_size, self.input_resolution // patch_size)
@@ -284,7 +356,7 @@ class VisualTransformer(nn.Module):
         self.positional_embedding = nn.Parameter(scale * torch.randn((input_resolution // patch_size) ** 2 + 1, width))
         self.ln_pre = LayerNorm(width)
 
-        self.transformer = Transformer(width, layers, heads, use_flash_attention=use_flash_attention)
+        self.transformer = Transformer(width, layers, heads)
 
         self.ln_post = LayerNorm(width)
         self.proj = nn.Parameter(scale * torch.randn(width, output_dim))
@@ -299,37 +371,31 @@ class VisualTransformer(nn.Module):
         len_keep = int((L - 1) * (1 - mask_ratio))
 
         noise = torch.rand(N, L - 1, device=x.device)
-        ids_shuffle = torch.argsort(noise, dim=1) + torch.ones(N, L - 1, device=x.device,
-                                                               dtype=int)
-        ids_keep = ids_shuffle[:, :len_keep]
+        ids_keep = torch.argsort(noise, dim=1)[:, :len_keep]  # indices into the patch tokens x[:, 1:]
 
-        x_masked = torch.gather(x, dim=1, index=ids_keep.unsqueeze(-1).repeat(1, 1, D))
+        # expand() broadcasts the index over D without materializing it
+        x_masked = torch.gather(x[:, 1:], dim=1, index=ids_keep.unsqueeze(-1).expand(-1, -1, D))
 
-        x0 = x[:, 0, :]
-        x0 = x0.reshape(N, 1, D)
-        x_masked_add = torch.cat([x0, x_masked], axis=1)
-        return x_masked_add
+        return torch.cat([x[:, :1], x_masked], dim=1)
 
     def forward(self, x: torch.Tensor, mask_ratio: float = 0.0, return_all_features=False):
         x = self.conv1(x)  # shape = [*, width, grid, grid]
         x = x.reshape(x.shape[0], x.shape[1], -1)  # shape = [*, width, grid ** 2]
         x = x.permute(0, 2, 1)  # shape = [*, grid ** 2, width]
-        x = torch.cat(
-            [self.class_embedding.to(x.dtype) + torch.zeros(x.shape[0], 1, x.shape[-1], dtype=x.dtype, device=x.device),
-             x], dim=1)  # shape = [*, grid ** 2 + 1, width]
-        x = x + self.positional_embedding.to(x.dtype)
+        # add the positional embedding before prepending the class token, so the class token row is a single
+        # [width] add broadcast over the batch instead of part of the full [*, grid ** 2 + 1, width] add
+        pos_embed = self.positional_embedding.to(x.dtype)
+        x = x + pos_embed[1:]
+        cls_token = self.class_embedding.to(x.dtype) + pos_embed[0]
+        x = torch.cat([cls_token.expand(x.shape[0], 1, -1), x], dim=1)  # shape = [*, grid ** 2 + 1, width]
         if mask_ratio != 0:
             x = self.random_masking(x, mask_ratio)
         x = self.ln_pre(x)
-        x = x.permute(1, 0, 2)  # NLD -> LND
-        x = self.transformer(x)
+        x = self.transformer(x)  # the transformer is batch first, NLD throughout
         # Optionally return all features before projection
         if return_all_features:
-            x=self.ln_post(x)
-            x = x.permute(1, 0, 2)  # LND -> NLD
-            return x
-            
-        x = x.permute(1, 0, 2)  # LND -> NLD
+            return self.ln_post(x)
+
         x = self.ln_post(x[:, 0, :])  # Only CLS token
         if self.proj is not None:
             x = x @ self.proj
@@ -361,6 +427,42 @@ class Mlp(nn.Module):
         return x
 
 
+class FusedTextProjection(nn.Module):
+    """The three text projection heads (Linear-ReLU-Linear on a shared input) run as two batched GEMMs instead of six.
+
+    The first layers are stacked into one Linear(H, 3H) and the second layers run as one bmm over [3, H, E] weights.
+    The stacked weights are non-persistent buffers copied from the heads, so checkpoints keep the keys of the
+    separate heads, but later updates of the heads are not reflected: this is for inference only.
+    """
+
+    def __init__(self, heads):
+        super().__init__()
+        self.register_buffer("weight1", torch.cat([h[0].weight for h in heads]).detach(), persistent=False)  # [3H, H]
+        self.register_buffer("bias1", torch.cat([h[0].bias for h in heads]).detach(), persistent=False)  # [3H]
+        self.register_buffer("weight2", torch.stack([h[2].weight.t() for h in heads]).detach(), persistent=False)  # [3, H, E]
+        self.register_buffer("bias2", torch.stack([h[2].bias for h in heads]).unsqueeze(1).detach(), persistent=False)  # [3, 1, E]
+
+    def forward(self, x):
+        x = F.relu(F.linear(x, self.weight1, self.bias1))  # [B, 3H]
+        x = x.reshape(x.shape[0], 3, -1).transpose(0, 1)  # [3, B, H]
+        return torch.baddbmm(self.bias2, x, self.weight2).unbind(0)  # 3 x [B, E]
+
+
+class FusedFeatureMapping(nn.Module):
+    """The left and right image feature mappings (bias-free Linear(E, E) each) run as one bmm over [2, E, E] weights.
+
+    Like FusedTextProjection, the stacked weights are non-persistent buffers copied from the mappings, so this is for
+    inference only.
+    """
+
+    def __init__(self, mappings):
+        super().__init__()
+        self.register_buffer("weight", torch.stack([m.weight.t() for m in mappings]).detach(), persistent=False)  # [2, E, E]
+
+    def forward(self, left, right):
+        return torch.bmm(torch.stack((left, right)), self.weight).unbind(0)  # 2 x [B, E]
+
+
 class CLIP(nn.Module):
     def __init__(self,
                  embed_dim: int,
@@ -407,7 +509,6 @@ class CLIP(nn.Module):
                 layers=vision_layers,
                 heads=vision_heads,
                 output_dim=embed_dim,
-                use_flash_attention=use_flash_attention,
             )
 
         self.bert_config = BertConfig(
@@ -436,6 +537,8 @@ class CLIP(nn.Module):
         self.text_projection_right = nn.Sequential(nn.Linear(text_hidden_size, text_hidden_size),
                                                    nn.ReLU(),
                                                    nn.Linear(text_hidden_size, embed_dim))
+        # set by fuse_projection_heads() for inference
+        self.fused_text_projection = None
 
         self.logit_scale = nn.Parameter(torch.ones([]) * np.log(90))
         self.logit_scale_left = nn.Parameter(torch.ones([]) * np.log(90))
@@ -444,8 +547,13 @@ class CLIP(nn.Module):
         self.global_feature_mapping = nn.Linear(2 * embed_dim, embed_dim, bias=False)
         self.left_feature_mapping = nn.Linear(embed_dim, embed_dim, bias=False)
         self.right_feature_mapping = nn.Linear(embed_dim, embed_dim, bias=False)
+        # set by fuse_projection_heads() for inference
+        self.fused_feature_mapping = None
 
         self.tokenizer = tokenizer
+        self.pad_index = self.tokenizer.vocab['[PAD]']
+        # encode the left and right images in a single pass of the visual tower; set to False to debug them separately
+        self.batch_image_pairs = True
 
         self.initialize_parameters()
 
@@ -491,43 +599,52 @@ class CLIP(nn.Module):
     def dtype(self):
         return self.visual.conv1.weight.dtype
 
+    def fuse_projection_heads(self):
+        """Run the three text projection heads as one FusedTextProjection in encode_text, and the left and right
+        feature mappings as one FusedFeatureMapping in encode_image.
+
+        Call this on an eval-mode model used for inference, after any precision conversion and device move.
+        """
+        assert not self.training, "Projection head fusion is only valid in eval mode."
+        self.fused_text_projection = FusedTextProjection(
+            [self.text_projection, self.text_projection_left, self.text_projection_right])
+        self.fused_feature_mapping = FusedFeatureMapping([self.left_feature_mapping, self.right_feature_mapping])
+        return self
+
+    def _encode_visual(self, img, mask_ratio=0):
+        if isinstance(self.visual, ModifiedResNet):
+            # mask_ratio > 0 (FLIP strategy) is currently only implemented for VisualTransformer.
+            # ModifiedResNet casts its input to the weight dtype itself.
+            return self.visual(img)
+        return self.visual(img.to(dtype=self.dtype), mask_ratio, return_all_features=True)
+
     def encode_image(self, img_l, img_r, mask_ratio=0, return_all_features=False):
         if img_r is None:
-            if isinstance(self.visual, ModifiedResNet):
-                # mask_ratio > 0 (FLIP strategy) is currently only implemented for VisualTransformer.
-                vision_feature = self.visual(img_l.type(self.dtype))
-                return vision_feature
-            vision_feature = self.visual(img_l.type(self.dtype), mask_ratio, return_all_features=True)
-            return vision_feature
+            return self._encode_visual(img_l, mask_ratio)
         if img_l is None:
-            if isinstance(self.visual, ModifiedResNet):
-                # mask_ratio > 0 (FLIP strategy) is currently only implemented for VisualTransformer.
-                vision_feature = self.visual(img_r.type(self.dtype))
-                return vision_feature
-            vision_feature = self.visual(img_r.type(self.dtype), mask_ratio, return_all_features=True)
-            return vision_feature
-        if isinstance(self.visual, ModifiedResNet):
-            # mask_ratio > 0 (FLIP strategy) is currently only implemented for VisualTransformer.
-            left_feature = self.visual(img_l.type(self.dtype))
-            right_feature = self.visual(img_r.type(self.dtype))
-            vision_feature = torch.cat(
-                (left_feature, right_feature), dim=1)
-
-            return self.global_feature_mapping(vision_feature), self.single_feature_mapping(
-                left_feature), self.single_feature_mapping(right_feature)
-        left_feature = self.visual(img_l.type(self.dtype), mask_ratio, return_all_features=True)
-        right_feature = self.visual(img_r.type(self.dtype), mask_ratio, return_all_features=True)
+            return self._encode_visual(img_r, mask_ratio)
+        # A training ResNet is kept on separate passes, since batching would change its BatchNorm statistics.
+        if self.batch_image_pairs and not (self.training and isinstance(self.visual, ModifiedResNet)):
+            left_feature, right_feature = self._encode_visual(torch.cat((img_l, img_r), dim=0), mask_ratio).split(
+                img_l.shape[0], dim=0)
+        else:
+            left_feature = self._encode_visual(img_l, mask_ratio)
+            right_feature = self._encode_visual(img_r, mask_ratio)
         vision_feature = torch.cat(
             (left_feature, right_feature), dim=1)
 
+        if self.fused_feature_mapping is not None:
+            left_feature, right_feature = self.fused_feature_mapping(left_feature, right_feature)
+            return self.global_feature_mapping(vision_feature), left_feature, right_feature
         return self.global_feature_mapping(vision_feature), self.left_feature_mapping(
             left_feature), self.right_feature_mapping(right_feature)
 
     def encode_text(self, text):
-        pad_index = self.tokenizer.vocab['[PAD]']
-        attn_mask = text.ne(pad_index).type(self.dtype)
+        attn_mask = (text != self.pad_index).to(dtype=self.dtype)
         x = self.bert(text, attention_mask=attn_mask)[0].type(self.dtype)  # [batch_size, seq_length, hidden_size]
 
+        if self.fused_text_projection is not None:
+            return self.fused_text_projection(x[:, 0, :])
         text = self.text_projection(x[:, 0, :])
         text_left = self.text_projection_left(x[:, 0, :])
         text_right = self.text_projection_right(x[:, 0, :])
@@ -578,7 +695,7 @@ class CLIP(nn.Module):
 def convert_models_to_fp32(model):
     for p in model.parameters():
         p.data = p.data.float()
-        if p.grad:
+        if p.grad is not None:
             p.grad.data = p.grad.data.float()
 
 
@@ -623,10 +740,12 @@ def convert_weights(model: nn.Module):
         #             attr.data = attr.data.half()  # 2023.10.14 should be 'attr.data'
 
     # model.apply(_convert_weights_to_fp16)
+    # Only parameters are cast: model.half() would also turn the BatchNorm running statistics into fp16.
+    # Each assignment releases the fp32 storage right away, so the peak overhead is a single parameter.
     for param in model.parameters():
         param.data = param.data.half()
-        if param.grad:
-            param.grad.data = param.grad.data.float()
+        if param.grad is not None:
+            param.grad.data = param.grad.data.half()
     # model.half()
 
 
@@ -656,103 +775,152 @@ def restore_model(model, clip_state_dict: dict, bert_state_dict: dict, use_flash
 
 
 def convert_state_dict(state_dict):
-    """Adapt to Flash Attention"""
+    """Adapt to Flash Attention
+
+    The visual transformer always uses the nn.MultiheadAttention layout (SDPA picks the flash kernel by itself),
+    so only legacy FlashMHA keys are mapped back for it. The BERT layers are converted in both directions.
+    """
     if not state_dict:
         return state_dict
 
-    prefix = 'module.' if list(state_dict.keys())[0].startswith('module') else ''
-
-    if f'{prefix}visual.transformer.resblocks.0.attn.in_proj_weight' in state_dict:
-        for k in list(state_dict.keys()):
-            if 'attn.in_proj_weight' in k:
-                state_dict[k.replace('attn.in_proj_weight', 'attn.Wqkv.weight')] = state_dict.pop(k)
-            elif 'attn.in_proj_bias' in k:
-                state_dict[k.replace('attn.in_proj_bias', 'attn.Wqkv.bias')] = state_dict.pop(k)
-    elif f'{prefix}visual.transformer.resblocks.0.attn.Wqkv.weight' in state_dict:
-        for k in list(state_dict.keys()):
-            if 'attn.Wqkv.weight' in k:
-                state_dict[k.replace('attn.Wqkv.weight', 'attn.in_proj_weight')] = state_dict.pop(k)
-            elif 'attn.Wqkv.bias' in k:
-                state_dict[k.replace('attn.Wqkv.bias', 'attn.in_proj_bias')] = state_dict.pop(k)
-
-    if f'{prefix}bert.encoder.layer.0.attention.self.query.weight' in state_dict:
-        i = 0
-        while f'{prefix}bert.encoder.layer.{i}.attention.self.query.weight' in state_dict:
-            state_dict[f'{prefix}bert.encoder.layer.{i}.attention.self.Wqkv.weight'] = torch.cat(
-                (state_dict.pop(f'{prefix}bert.encoder.layer.{i}.attention.self.query.weight'),
-                 state_dict.pop(f'{prefix}bert.encoder.layer.{i}.attention.self.key.weight'),
-                 state_dict.pop(f'{prefix}bert.encoder.layer.{i}.attention.self.value.weight'))
-            )
-            state_dict[f'{prefix}bert.encoder.layer.{i}.attention.self.Wqkv.bias'] = torch.cat(
-                (state_dict.pop(f'{prefix}bert.encoder.layer.{i}.attention.self.query.bias'),
-                 state_dict.pop(f'{prefix}bert.encoder.layer.{i}.attention.self.key.bias'),
-                 state_dict.pop(f'{prefix}bert.encoder.layer.{i}.attention.self.value.bias'))
-            )
-            state_dict[f'{prefix}bert.encoder.layer.{i}.attention.self.out_proj.weight'] = \
-                state_dict.pop(f'{prefix}bert.encoder.layer.{i}.attention.output.dense.weight')
-            state_dict[f'{prefix}bert.encoder.layer.{i}.attention.self.out_proj.bias'] = \
-                state_dict.pop(f'{prefix}bert.encoder.layer.{i}.attention.output.dense.bias')
-            i += 1
-    elif f'{prefix}bert.encoder.layer.0.attention.self.Wqkv.weight' in state_dict:
-        i = 0
-        while f'{prefix}bert.encoder.layer.{i}.attention.self.Wqkv.weight' in state_dict:
-            state_dict[f'{prefix}bert.encoder.layer.{i}.attention.self.query.weight'], \
-                state_dict[f'{prefix}bert.encoder.layer.{i}.attention.self.key.weight'], \
-                state_dict[f'{prefix}bert.encoder.layer.{i}.attention.self.value.weight'] = \
-                torch.chunk(state_dict.pop(f'{prefix}bert.encoder.layer.{i}.attention.self.Wqkv.weight'), chunks=3)
-            state_dict[f'{prefix}bert.encoder.layer.{i}.attention.self.query.bias'], \
-                state_dict[f'{prefix}bert.encoder.layer.{i}.attention.self.key.bias'], \
-                state_dict[f'{prefix}bert.encoder.layer.{i}.attention.self.value.bias'] = \
-                torch.chunk(state_dict.pop(f'{prefix}bert.encoder.layer.{i}.attention.self.Wqkv.bias'), chunks=3)
-            state_dict[f'{prefix}bert.encoder.layer.{i}.attention.output.dense.weight'] = \
-                state_dict.pop(f'{prefix}bert.encoder.layer.{i}.attention.self.out_proj.weight')
-            state_dict[f'{prefix}bert.encoder.layer.{i}.attention.output.dense.bias'] = \
-                state_dict.pop(f'module.bert.encoder.layer.{i}.attention.self.out_proj.bias')
-            i += 1
+    prefix = 'module.' if next(iter(state_dict)).startswith('module') else ''
+
+    if f'{prefix}visual.transformer.resblocks.0.attn.Wqkv.weight' in state_dict:
+        _rename_keys(state_dict, [(k, k.replace('attn.Wqkv.', 'attn.in_proj_')) for k in state_dict if 'attn.Wqkv.' in k])
+
+    layout, layer_ids = _bert_attention_layout(state_dict, prefix)
+    if layout == 'query':
+        for param in ('weight', 'bias'):
+            # a single buffer holds the fused parameter of every layer, each layer's Wqkv is a view into it.
+            # It is allocated before any q/k/v source is released, so the peak is the sources plus the whole buffer
+            # (about twice the QKV parameters) in exchange for one allocation instead of one per layer.
+            first = state_dict[f'{prefix}bert.encoder.layer.{layer_ids[0]}.attention.self.query.{param}']
+            fused = first.new_empty((len(layer_ids), 3 * first.shape[0]) + first.shape[1:])
+            for i, out in zip(layer_ids, fused):
+                attention = f'{prefix}bert.encoder.layer.{i}.attention'
+                state_dict[f'{attention}.self.Wqkv.{param}'] = _pop_and_concat(
+                    state_dict, [f'{attention}.self.{name}.{param}' for name in ('query', 'key', 'value')], out)
+        _rename_keys(state_dict, [(f'{prefix}bert.encoder.layer.{i}.attention.output.dense.{param}',
+                                   f'{prefix}bert.encoder.layer.{i}.attention.self.out_proj.{param}')
+                                  for i in layer_ids for param in ('weight', 'bias')])
+    elif layout == 'Wqkv':
+        for i in layer_ids:
+            attention = f'{prefix}bert.encoder.layer.{i}.attention'
+            for param in ('weight', 'bias'):
+                wqkv = state_dict.pop(f'{attention}.self.Wqkv.{param}')
+                size = wqkv.shape[0] // 3
+                # narrow() returns views, q/k/v keep sharing the fused storage
+                for j, name in enumerate(('query', 'key', 'value')):
+                    state_dict[f'{attention}.self.{name}.{param}'] = wqkv.narrow(0, j * size, size)
+        _rename_keys(state_dict, [(f'{prefix}bert.encoder.layer.{i}.attention.self.out_proj.{param}',
+                                   f'{prefix}bert.encoder.layer.{i}.attention.output.dense.{param}')
+                                  for i in layer_ids for param in ('weight', 'bias')])
 
     return state_dict
 
 
-def resize_pos_embed(state_dict, model, interpolation: str = 'bicubic', seq_dim=1, prefix=""):
+def _rename_keys(state_dict, renames):
+    """Move each value of state_dict from the old to the new key of the (old, new) pairs in `renames`."""
+    for old, new in renames:
+        state_dict[new] = state_dict.pop(old)
+
+
+def _bert_attention_layout(state_dict, prefix):
+    """Classify the BERT self-attention layout of state_dict in a single pass over its keys.
+
+    Returns ('query', layer_ids) for separate q/k/v projections, ('Wqkv', layer_ids) for fused ones
+    and (None, []) if the state_dict holds no BERT encoder.
+    """
+    pattern = re.compile(rf'{re.escape(prefix)}bert\.encoder\.layer\.(\d+)\.attention\.self\.(query|Wqkv)\.weight')
+    layer_ids = {'query': [], 'Wqkv': []}
+    for m in map(pattern.fullmatch, state_dict):
+        if m:
+            layer_ids[m.group(2)].append(int(m.group(1)))
+    for layout in ('query', 'Wqkv'):
+        if layer_ids[layout]:
+            return layout, sorted(layer_ids[layout])
+    return None, []
+
+
+def _pop_and_concat(state_dict, keys, out):
+    """torch.cat the tensors popped from state_dict along dim 0 into `out`, releasing each one right after it is
+    copied."""
+    size = state_dict[keys[0]].shape[0]
+    for j, key in enumerate(keys):
+        out[j * size:(j + 1) * size].copy_(state_dict.pop(key))
+    return out
+
+
+def resize_pos_embed(state_dict, model, interpolation: str = 'bilinear', seq_dim=1, prefix=""):
     # Rescale the grid of position embeddings when loading from state_dict
     old_pos_embed = state_dict.get(prefix + 'visual.positional_embedding', None)
-    model = model.module if hasattr(model, 'module') else model
-    if old_pos_embed is None or not hasattr(model.visual, 'grid_size'):
+    if old_pos_embed is None:
+        return
+    visual = getattr(model, 'module', model).visual
+    grid_size = getattr(visual, 'grid_size', None)
+    if grid_size is None:
         return
-    grid_size = to_2tuple(model.visual.grid_size)
+    # the common case: the checkpoint already matches the model's own positional embedding
+    if old_pos_embed.shape[0] == visual.positional_embedding.shape[0]:
+        return
+    grid_size = to_2tuple(grid_size)
     extra_tokens = 1  # FIXME detect different token configs (ie no class token, or more)
     new_seq_len = grid_size[0] * grid_size[1] + extra_tokens
-    if new_seq_len == old_pos_embed.shape[0]:
-        return
 
     if extra_tokens:
         pos_emb_tok, pos_emb_img = old_pos_embed[:extra_tokens], old_pos_embed[extra_tokens:]
     else:
         pos_emb_tok, pos_emb_img = None, old_pos_embed
-    old_grid_size = to_2tuple(int(math.sqrt(len(pos_emb_img))))
+    old_grid_side = math.isqrt(pos_emb_img.shape[0])  # exact for square grids, unlike int(math.sqrt(...))
+    old_grid_size = (old_grid_side, old_grid_side)
 
     logging.info('Resizing position embedding grid-size from %s to %s', old_grid_size, grid_size)
-    pos_emb_img = pos_emb_img.reshape(1, old_grid_size[0], old_grid_size[1], -1).permute(0, 3, 1, 2)
+    # resample on the model's device: CUDA has fast interpolate kernels, and the resized embedding is then already
+    # where load_state_dict will copy it to
+    device = visual.positional_embedding.device
+    pos_emb_img = _interpolate_pos_grid(pos_emb_img.to(device), old_grid_size, grid_size, interpolation)
+
+    new_pos_embed = old_pos_embed.new_empty((new_seq_len, old_pos_embed.shape[-1]), device=device)
+    if pos_emb_tok is not None:
+        new_pos_embed[:extra_tokens].copy_(pos_emb_tok)
+    new_pos_embed[extra_tokens:].copy_(pos_emb_img)  # also casts back from the fp32 scratch, if any
+    state_dict[prefix + 'visual.positional_embedding'] = new_pos_embed
+
+
+def _interpolate_pos_grid(pos_emb_img: torch.Tensor, old_grid_size: Tuple[int, int], grid_size: Tuple[int, int],
+                          mode: str) -> torch.Tensor:
+    """Resample a (H*W, C) grid of position embeddings to grid_size, returned as a (H'*W', C) view.
+
+    fp16/bf16 grids come back as float32, float32 and float64 grids keep their dtype.
+    """
+    # (HW, C) -> (1, C, H, W) and back are plain 2D transposes, kept as views so that the caller does the only copy;
+    # the (1, C, H, W) view is channels-last strided, which is the vectorized layout of the interpolate kernels.
+    # Interpolate half-precision checkpoints in fp32, they would otherwise hit the slow CPU kernels.
+    if pos_emb_img.dtype not in (torch.float32, torch.float64):
+        pos_emb_img = pos_emb_img.float()
+    pos_emb_img = pos_emb_img.t().reshape(1, -1, old_grid_size[0], old_grid_size[1])
     pos_emb_img = F.interpolate(
         pos_emb_img,
         size=grid_size,
-        mode=interpolation,
+        mode=mode,
         align_corners=True,
     )
-    pos_emb_img = pos_emb_img.permute(0, 2, 3, 1).reshape(1, grid_size[0] * grid_size[1], -1)[0]
-    if pos_emb_tok is not None:
-        new_pos_embed = torch.cat([pos_emb_tok, pos_emb_img], dim=0)
-    else:
-        new_pos_embed = pos_emb_img
-    state_dict[prefix + 'visual.positional_embedding'] = new_pos_embed
+    return pos_emb_img.reshape(-1, grid_size[0] * grid_size[1]).t()
 
 
 # From PyTorch internals
+@functools.lru_cache(maxsize=None)
 def _ntuple(n):
     def parse(x):
+        # concrete type checks first, the Iterable ABC check is comparatively slow
+        t = type(x)
+        if t is tuple:
+            return x
+        if t is int or t is float:
+            return (x,) * n
         if isinstance(x, collections.abc.Iterable):
             return x
-        return tuple(repeat(x, n))
+        return (x,) * n
 
     return parse
 
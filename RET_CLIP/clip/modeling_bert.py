@@ -264,7 +264,7 @@ class BertEncoder(nn.Module):
                 all_hidden_states = all_hidden_states + (hidden_states,)
 
             if self.grad_checkpointing and not torch.jit.is_scripting():
-                layer_outputs = checkpoint(layer_module, hidden_states, attention_mask, head_mask[i])
+                layer_outputs = checkpoint(layer_module, hidden_states, attention_mask, head_mask[i], use_reentrant=False)
             else:
                 layer_outputs = layer_module(hidden_states, attention_mask, head_mask[i])
             if not isinstance(layer_outputs, tuple):
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+This script checks the attention and LayerNorm layers of RET-CLIP against the implementations they replace,
+and the gradients of the grad-checkpointed visual transformer against plain eager ones, using the same weights and
+inputs, and reports the largest absolute difference of each comparison.
+"""
+
+import argparse
+import copy
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from RET_CLIP.clip.model import MultiheadAttention, AttentionPool2d, LayerNorm, VisualTransformer, \
+    _scaled_dot_product_attention_math
+import RET_CLIP.clip.model as clip_model
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", choices=["cuda", "cpu"], default="cpu", help="Device to run the checks on. Default to cpu.")
+    parser.add_argument("--dtype", choices=["fp32", "fp16"], default="fp32", help="Precision of weights and inputs. Default to fp32.")
+    parser.add_argument("--atol", type=float, default=None, help="Absolute tolerance, default to 1e-5 for fp32 and 2e-3 for fp16.")
+    args = parser.parse_args()
+    if args.atol is None:
+        args.atol = 1e-5 if args.dtype == "fp32" else 2e-3
+    return args
+
+
+def check_multihead_attention(device, dtype, batch_size=4, seq_len=50, width=768, heads=12):
+    """MultiheadAttention vs nn.MultiheadAttention (batch_first), without and with a causal mask."""
+    attn = MultiheadAttention(width, heads).to(device, dtype).eval()
+    ref = nn.MultiheadAttention(width, heads, batch_first=True).to(device, dtype).eval()
+    ref.load_state_dict(attn.state_dict())
+
+    x = torch.randn(batch_size, seq_len, width, device=device, dtype=dtype)
+    mask = torch.full((seq_len, seq_len), float("-inf"), device=device, dtype=dtype).triu_(1)
+    diffs = {}
+    for name, attn_mask in [("no mask", None), ("causal mask", mask)]:
+        expected = ref(x, x, x, attn_mask=attn_mask, need_weights=False)[0]
+        diffs[name] = (attn(x, attn_mask) - expected).abs().max().item()
+    return diffs
+
+
+def check_attention_pool(device, dtype, batch_size=4, spacial_dim=7, embed_dim=2048, heads=32, output_dim=1024):
+    """AttentionPool2d vs the original F.multi_head_attention_forward over the full (HW+1) sequence."""
+    pool = AttentionPool2d(spacial_dim, embed_dim, heads, output_dim).to(device, dtype).eval()
+    x = torch.randn(batch_size, embed_dim, spacial_dim, spacial_dim, device=device, dtype=dtype)
+
+    ref = x.flatten(start_dim=2).permute(2, 0, 1)  # NCHW -> (HW)NC
+    ref = torch.cat([ref.mean(dim=0, keepdim=True), ref], dim=0)  # (HW+1)NC
+    ref = ref + pool.positional_embedding[:, None, :].to(ref.dtype)
+    expected, _ = F.multi_head_attention_forward(
+        query=ref, key=ref, value=ref,
+        embed_dim_to_check=ref.shape[-1],
+        num_heads=pool.num_heads,
+        q_proj_weight=pool.q_proj.weight,
+        k_proj_weight=pool.k_proj.weight,
+        v_proj_weight=pool.v_proj.weight,
+        in_proj_weight=None,
+        in_proj_bias=torch.cat([pool.q_proj.bias, pool.k_proj.bias, pool.v_proj.bias]),
+        bias_k=None,
+        bias_v=None,
+        add_zero_attn=False,
+        dropout_p=0,
+        out_proj_weight=pool.c_proj.weight,
+        out_proj_bias=pool.c_proj.bias,
+        use_separate_proj_weight=True,
+        training=False,
+        need_weights=False
+    )
+    return {"pooled token": (pool(x) - expected[0]).abs().max().item()}
+
+
+def check_layer_norm(device, dtype, batch_size=4, seq_len=50, width=768):
+    """The native half-precision layer_norm of LayerNorm's fast path vs the old fp32 round-trip."""
+    ln = LayerNorm(width).to(device, dtype).eval()
+    nn.init.normal_(ln.weight, mean=1.0, std=0.1)
+    nn.init.normal_(ln.bias, std=0.1)
+    x = torch.randn(batch_size, seq_len, width, device=device, dtype=dtype) * 4 + 1
+
+    # the old implementation: normalize in fp32 and cast the result back
+    expected = F.layer_norm(x.float(), ln.normalized_shape, ln.weight.float(), ln.bias.float(), ln.eps).type(dtype)
+    # call the fast path explicitly, LayerNorm.forward only takes it for CUDA inputs
+    fast = F.layer_norm(x, ln.normalized_shape, ln.weight, ln.bias, ln.eps)
+    diffs = {"native kernel": (fast - expected).abs().max().item()}
+    if x.is_cuda:
+        diffs["forward"] = (ln(x) - expected).abs().max().item()
+    return diffs
+
+
+def check_grad_checkpointing(device, dtype, batch_size=4, resolution=64, patch_size=16, width=768, layers=2, heads=12):
+    """First-step gradients of a grad-checkpointed VisualTransformer vs the same model without checkpointing.
+
+    Run this first in a fresh process: a wrong gradient on the first (profiling) call of a scripted function
+    only shows up there. Differences are relative to the largest gradient of each parameter.
+    """
+    model = VisualTransformer(resolution, patch_size, width, layers, heads, output_dim=512).to(device, dtype)
+    ref = copy.deepcopy(model)
+    model.set_grad_checkpointing()
+    x = torch.randn(batch_size, 3, resolution, resolution, device=device, dtype=dtype)
+    for m in (model, ref):
+        m(x).float().square().sum().backward()
+    diff = max(((p.grad - q.grad).abs().max() / q.grad.abs().max()).item()
+               for p, q in zip(model.parameters(), ref.parameters()))
+    return {"first-step grads": diff}
+
+
+def main():
+    args = parse_args()
+    dtype = torch.float16 if args.dtype == "fp16" else torch.float32
+    torch.manual_seed(0)
+
+    checks = [("MultiheadAttention", check_multihead_attention), ("AttentionPool2d", check_attention_pool)]
+    failed = False
+    for case, diff in check_grad_checkpointing(args.device, dtype).items():
+        ok = diff <= args.atol
+        failed |= not ok
+        print(f"Grad checkpointing ({case}): max rel diff {diff:.3e} {'OK' if ok else 'FAILED'}")
+    with torch.no_grad():
+        sdpa_fused = clip_model.scaled_dot_product_attention
+        for sdpa_name, sdpa in [("fused SDPA", sdpa_fused),
+                                ("math fallback", _scaled_dot_product_attention_math)]:
+            # the math fallback is what torch < 2.0 and the ONNX export run
+            clip_model.scaled_dot_product_attention = sdpa
+            for check_name, check in checks:
+                for case, diff in check(args.device, dtype).items():
+                    ok = diff <= args.atol
+                    failed |= not ok
+                    print(f"{check_name} ({sdpa_name}, {case}): max abs diff {diff:.3e} {'OK' if ok else 'FAILED'}")
+        clip_model.scaled_dot_product_attention = sdpa_fused
+        for case, diff in check_layer_norm(args.device, dtype).items():
+            ok = diff <= args.atol
+            failed |= not ok
+            print(f"LayerNorm ({case}): max abs diff {diff:.3e} {'OK' if ok else 'FAILED'}")
+    assert not failed, f"Some checks exceed atol={args.atol}."
+
+
+if __name__ == "__main__":
+    main()
@@ -12,7 +12,7 @@ import json
 import torch
 from tqdm import tqdm
 
-from RET_CLIP.clip.model import convert_weights, CLIP
+from RET_CLIP.clip.model import convert_weights, CLIP, ModifiedResNet
 from RET_CLIP.training.main import convert_models_to_fp32
 from RET_CLIP.eval.data import get_eval_img_dataset, get_eval_txt_dataset
 
@@ -160,6 +160,10 @@ if __name__ == "__main__":
     print(
         f"=> loaded checkpoint '{args.resume}' (epoch {checkpoint['epoch']} @ {checkpoint['step']} steps)"
     )
+    model.eval()
+    if isinstance(model.visual, ModifiedResNet):
+        model.visual.fuse_for_inference()
+    model.fuse_projection_heads()
 
     # Make inference for texts
     if args.extract_text_feats:
@@ -13,7 +13,7 @@ import torch
 import sys
 sys.path.append(".")
 
-from RET_CLIP.clip.model import convert_weights, CLIP
+from RET_CLIP.clip.model import convert_weights, CLIP, ModifiedResNet
 from RET_CLIP.clip import tokenize
 from RET_CLIP.training.main import convert_models_to_fp32
 from RET_CLIP.clip.utils import image_transform
@@ -240,6 +240,9 @@ if __name__ == "__main__":
     print('Building zero-shot classifier')
 
     model.eval()
+    if isinstance(model.visual, ModifiedResNet):
+        model.visual.fuse_for_inference()
+    model.fuse_projection_heads()
 
     print(summary(model))
     for images, labels in data[args.dataset].dataloader:
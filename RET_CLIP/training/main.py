@@ -27,7 +27,7 @@ from RET_CLIP.training.scheduler import cosine_lr
 def convert_models_to_fp32(model):
     for p in model.parameters():
         p.data = p.data.float()
-        if p.grad:
+        if p.grad is not None:
             p.grad.data = p.grad.data.float()
 
 
@@ -111,11 +111,19 @@ def main():
         convert_weights(model)
 
     if args.grad_checkpointing:
-        assert not torch_version_str_compare_lessequal(torch.__version__, "1.8.0"), \
-            "Currently our grad_checkpointing is not compatible with torch version <= 1.8.0."
+        assert not torch_version_str_compare_lessequal(torch.__version__, "1.10.2"), \
+            "Currently our grad_checkpointing is not compatible with torch version <= 1.10.2."
         model.set_grad_checkpointing()
         logging.info("Grad-checkpointing activated.")
 
+    if args.torch_compile:
+        assert hasattr(torch.nn.Module, "compile"), "--torch-compile requires torch >= 2.2."
+        if hasattr(model.visual, "transformer"):
+            model.visual.transformer.compile_resblocks()
+            logging.info("torch.compile activated for the visual transformer.")
+        else:
+            logging.warning("--torch-compile only applies to ViT backbones, the ResNet visual encoder is not compiled.")
+
     if args.use_flash_attention:
         assert importlib.util.find_spec("flash_attn"), "flash_attn is not installed."
         logging.info("Using FlashAttention.")
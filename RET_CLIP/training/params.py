@@ -188,6 +188,12 @@ def parse_args():
         action='store_true',
         help="Enable gradient checkpointing.",
     )
+    parser.add_argument(
+        "--torch-compile",
+        default=False,
+        action='store_true',
+        help="Compile the residual blocks of the visual transformer with torch.compile (requires torch >= 2.2).",
+    )
     parser.add_argument(
         "--use-flash-attention",
         default=False,